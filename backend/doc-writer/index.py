@@ -1,19 +1,665 @@
 import json
 import os
-import urllib.request
+import base64
+import math
+import re
+import sqlite3
+import tempfile
+import uuid
+import zipfile
+import html
+import io
+import threading
+import time
+import http.client
+import urllib.parse
 import urllib.error
+from xml.sax.saxutils import escape as xml_escape
+import boto3
+
+CHARS_PER_PAGE = 1800
+WORDS_PER_PAGE = 300
+MIN_SECTION_WORDS = 100
+CHARS_PER_WORD = CHARS_PER_PAGE // WORDS_PER_PAGE
+MAX_PAGES = int(os.environ.get('MAX_PAGES', '100'))
+EXPORT_RUN_SECONDS = int(os.environ.get('EXPORT_RUN_SECONDS', '25'))
+EXPORT_INLINE_MAX_BYTES = int(os.environ.get('EXPORT_INLINE_MAX_BYTES', str(4 * 1024 * 1024)))
+
+EXPORT_FORMATS = {
+    'docx': ('docx', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
+    'markdown': ('md', 'text/markdown; charset=utf-8'),
+    'html': ('html', 'text/html; charset=utf-8'),
+    'pdf': ('html', 'text/html; charset=utf-8')
+}
+
+GEMINI_HOST = 'generativelanguage.googleapis.com'
+
+WARM_STATE = {
+    'loaded_at': time.time(),
+    'warmed_at': None,
+    'invocations': 0,
+    'connections': [],
+    'lock': threading.Lock(),
+    'checks': {}
+}
+
+
+def open_gemini_connection() -> http.client.HTTPSConnection:
+    '''Открывает keep-alive соединение с Gemini, при наличии PROXY_URL через CONNECT-туннель'''
+    proxy_url = os.environ.get('PROXY_URL')
+    if not proxy_url:
+        return http.client.HTTPSConnection(GEMINI_HOST, 443)
+    proxy = urllib.parse.urlparse(proxy_url)
+    conn = http.client.HTTPSConnection(proxy.hostname, proxy.port or (443 if proxy.scheme == 'https' else 80))
+    tunnel_headers = {}
+    if proxy.username:
+        credentials = f'{urllib.parse.unquote(proxy.username)}:{urllib.parse.unquote(proxy.password or "")}'
+        tunnel_headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+    conn.set_tunnel(GEMINI_HOST, 443, tunnel_headers)
+    return conn
+
+
+def call_gemini(method: str, path: str, payload: dict = None, timeout: float = 20) -> dict:
+    '''Выполняет запрос к Gemini через пул соединений контейнера и возвращает JSON-ответ'''
+    body = json.dumps(payload).encode('utf-8') if payload is not None else None
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    for attempt in range(2):
+        with WARM_STATE['lock']:
+            conn = WARM_STATE['connections'].pop() if WARM_STATE['connections'] else None
+        reused = conn is not None
+        conn = conn or open_gemini_connection()
+        conn.timeout = timeout
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            data = response.read()
+        except ConnectionError:
+            conn.close()
+            # Простаивавшее соединение могло быть закрыто сервером — повторяем один раз на новом
+            if reused and attempt == 0:
+                continue
+            raise
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            with WARM_STATE['lock']:
+                WARM_STATE['connections'].append(conn)
+        if response.status >= 400:
+            raise urllib.error.HTTPError(f'https://{GEMINI_HOST}{path.split("?")[0]}', response.status, response.reason, response.headers, io.BytesIO(data))
+        return json.loads(data.decode('utf-8'))
+
+
+def run_check(check) -> dict:
+    started = time.monotonic()
+    try:
+        check()
+        return {'ok': True, 'ms': round((time.monotonic() - started) * 1000)}
+    except Exception as e:
+        return {'ok': False, 'ms': round((time.monotonic() - started) * 1000), 'error': str(e)}
+
+
+def health_report() -> dict:
+    '''Состояние прогрева контейнера для планировщика'''
+    now = time.time()
+    warmed_at = WARM_STATE['warmed_at']
+    return {
+        'ready': warmed_at is not None and bool(os.environ.get('GEMINI_API_KEY')) and all(check['ok'] for check in WARM_STATE['checks'].values()),
+        'warm': warmed_at is not None,
+        'warmAgeSeconds': round(now - warmed_at, 1) if warmed_at else None,
+        'uptimeSeconds': round(now - WARM_STATE['loaded_at'], 1),
+        'invocations': WARM_STATE['invocations'],
+        'checks': WARM_STATE['checks']
+    }
+
+
+def prewarm() -> dict:
+    '''Прогревает контейнер: открывает соединение с Gemini в пуле и локальные кэши'''
+    api_key = os.environ.get('GEMINI_API_KEY', '')
+    checks = {'gemini': run_check(lambda: call_gemini('GET', f'/v1beta/models?pageSize=1&key={api_key}', timeout=10))}
+    checks['ledger'] = run_check(get_ledger)
+    if os.environ.get('AWS_ACCESS_KEY_ID'):
+        checks['storage'] = run_check(get_s3_client)
+    WARM_STATE['checks'] = checks
+    WARM_STATE['warmed_at'] = time.time()
+    return health_report()
+
+
+TOKEN_LEDGER_PATH = os.environ.get('TOKEN_LEDGER_PATH', '/tmp/token_ledger.db')
+MAX_PROMPT_TOKENS = int(os.environ.get('MAX_PROMPT_TOKENS', '4000'))
+MAX_OUTPUT_TOKENS = int(os.environ.get('MAX_OUTPUT_TOKENS', '8000'))
+MAX_REQUEST_COST_USD = float(os.environ.get('MAX_REQUEST_COST_USD', '0.005'))
+CLIENT_DAILY_TOKENS = int(os.environ.get('CLIENT_DAILY_TOKENS', '200000'))
+INPUT_TOKEN_PRICE_USD = float(os.environ.get('INPUT_TOKEN_PRICE_USD', '0.10')) / 1_000_000
+OUTPUT_TOKEN_PRICE_USD = float(os.environ.get('OUTPUT_TOKEN_PRICE_USD', '0.40')) / 1_000_000
+OUTPUT_TOKENS_PER_WORD = 2.5
+
+TOKEN_PATTERNS = (
+    (re.compile(r'[A-Za-z]+'), 4.0),
+    (re.compile(r'[А-Яа-яЁё]+'), 2.5),
+    (re.compile(r'\d+'), 3.0),
+    (re.compile(r'[^\sA-Za-zА-Яа-яЁё\d]'), 1.0)
+)
+
+
+def estimate_tokens(text: str) -> int:
+    '''Быстро оценивает число токенов Gemini для русского и английского текста'''
+    tokens = 0
+    for pattern, chars_per_token in TOKEN_PATTERNS:
+        for match in pattern.findall(text):
+            tokens += math.ceil(len(match) / chars_per_token)
+    return tokens
+
+
+def get_client_id(event: dict) -> str:
+    '''Определяет клиента для учёта токенов: пользователь из авторизатора шлюза или IP источника'''
+    request_context = event.get('requestContext') or {}
+    authorizer = request_context.get('authorizer') or {}
+    user_id = authorizer.get('principalId') or (authorizer.get('claims') or {}).get('sub')
+    if user_id:
+        return f'user:{user_id}'
+    source_ip = (request_context.get('identity') or {}).get('sourceIp')
+    return f'ip:{source_ip}' if source_ip else 'anonymous'
+
+
+def get_ledger() -> sqlite3.Connection:
+    '''Возвращает общий для всех вызовов контейнера журнал расхода токенов'''
+    if WARM_STATE.get('ledger') is None:
+        conn = sqlite3.connect(TOKEN_LEDGER_PATH, check_same_thread=False)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS token_usage (
+                client_id TEXT NOT NULL,
+                day TEXT NOT NULL,
+                requests INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                output_tokens INTEGER NOT NULL DEFAULT 0,
+                cost_usd REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (client_id, day)
+            )
+        ''')
+        WARM_STATE['ledger'] = conn
+    return WARM_STATE['ledger']
+
+
+def record_usage(client_id: str, prompt_tokens: int, output_tokens: int):
+    if prompt_tokens < 0 or output_tokens < 0:
+        raise ValueError('Число токенов не может быть отрицательным')
+    cost = prompt_tokens * INPUT_TOKEN_PRICE_USD + output_tokens * OUTPUT_TOKEN_PRICE_USD
+    ledger = get_ledger()
+    ledger.execute(
+        '''INSERT INTO token_usage (client_id, day, requests, prompt_tokens, output_tokens, cost_usd)
+           VALUES (?, date('now'), 1, ?, ?, ?)
+           ON CONFLICT (client_id, day) DO UPDATE SET
+               requests = requests + 1,
+               prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+               output_tokens = output_tokens + excluded.output_tokens,
+               cost_usd = cost_usd + excluded.cost_usd''',
+        (client_id, prompt_tokens, output_tokens, cost)
+    )
+    ledger.commit()
+
+
+def usage_estimate(prompt_tokens: int, output_tokens: int) -> dict:
+    if prompt_tokens < 0 or output_tokens < 0:
+        raise ValueError('Число токенов не может быть отрицательным')
+    cost = prompt_tokens * INPUT_TOKEN_PRICE_USD + output_tokens * OUTPUT_TOKEN_PRICE_USD
+    return {'promptTokens': prompt_tokens, 'outputTokens': output_tokens, 'costUsd': round(cost, 6)}
+
+
+def check_request_limits(prompt_tokens: int, output_tokens: int) -> dict:
+    '''Проверяет один вызов по лимитам токенов и стоимости, возвращает описание отказа или None'''
+    if prompt_tokens > MAX_PROMPT_TOKENS:
+        return {'statusCode': 413, 'error': 'Слишком длинный запрос, сократите описание или дополнительные требования',
+                'estimate': usage_estimate(prompt_tokens, output_tokens), 'limit': MAX_PROMPT_TOKENS}
+    return check_batch_limits(prompt_tokens, output_tokens)
+
+
+def check_batch_limits(prompt_tokens: int, output_tokens: int) -> dict:
+    '''Проверяет суммарный объем генерации и стоимость одного вызова функции'''
+    estimate = usage_estimate(prompt_tokens, output_tokens)
+    if output_tokens > MAX_OUTPUT_TOKENS or estimate['costUsd'] > MAX_REQUEST_COST_USD:
+        return {'statusCode': 413, 'error': 'Слишком большой объем генерации за один запрос',
+                'estimate': estimate, 'limit': MAX_OUTPUT_TOKENS}
+    return None
+
+
+def remaining_daily_tokens(client_id: str) -> int:
+    used = get_ledger().execute(
+        "SELECT prompt_tokens + output_tokens FROM token_usage WHERE client_id = ? AND day = date('now')",
+        (client_id,)
+    ).fetchone()
+    return CLIENT_DAILY_TOKENS - (used[0] if used else 0)
+
+
+def check_daily_budget(client_id: str, prompt_tokens: int, output_tokens: int) -> dict:
+    remaining = remaining_daily_tokens(client_id)
+    if prompt_tokens + output_tokens > remaining:
+        return {'statusCode': 429, 'error': 'Дневной лимит токенов исчерпан',
+                'estimate': usage_estimate(prompt_tokens, output_tokens),
+                'used': CLIENT_DAILY_TOKENS - remaining, 'limit': CLIENT_DAILY_TOKENS}
+    return None
+
+
+def admit_request(client_id: str, prompt_tokens: int, output_tokens: int) -> dict:
+    '''Проверяет запрос по бюджетам токенов и стоимости, возвращает описание отказа или None'''
+    return check_request_limits(prompt_tokens, output_tokens) or check_daily_budget(client_id, prompt_tokens, output_tokens)
+
+
+def rejection_response(rejection: dict) -> dict:
+    return {
+        'statusCode': rejection.pop('statusCode'),
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(rejection, ensure_ascii=False),
+        'isBase64Encoded': False
+    }
+
+
+def section_target_words(section_title: str, pages: int, sections_count: int) -> int:
+    total_words_needed = pages * WORDS_PER_PAGE
+    words_for_intro_conclusion = 400
+    words_for_sections = total_words_needed - words_for_intro_conclusion
+    words_per_section = max(words_for_sections // sections_count, MIN_SECTION_WORDS) if sections_count > 0 else 500
+    
+    if 'введение' in section_title.lower() or 'заключение' in section_title.lower():
+        return 200
+    return words_per_section
+
+
+def build_section_prompt(doc_type: str, subject: str, section_title: str, section_description: str,
+                         additional_info: str, pages: int, sections_count: int) -> str:
+    '''Собирает промпт для генерации одного раздела документа'''
+    target_words = section_target_words(section_title, pages, sections_count)
+    
+    return f"""Напиши раздел для академического документа ({doc_type}) на тему: {subject}
+
+РАЗДЕЛ: {section_title}
+ОПИСАНИЕ: {section_description}
+
+КРИТИЧНЫЕ ТРЕБОВАНИЯ:
+- Объем: СТРОГО {target_words} слов (это обязательно!)
+- Академический стиль, научная терминология
+- Логичное изложение с примерами и деталями
+- Раскрывай тему МАКСИМАЛЬНО подробно
+- Используй абзацы для структуры
+- Приводи конкретные примеры и факты
+- Пиши развернуто, не сокращай
+
+{f'Дополнительные требования: {additional_info}' if additional_info else ''}
+
+ВАЖНО: Текст должен быть РОВНО {target_words} слов! Не меньше!
+Напиши ТОЛЬКО текст раздела, без заголовка раздела."""
+
+
+def generate_text(prompt: str, api_key: str, timeout: int = 20) -> str:
+    '''Отправляет промпт в Gemini и возвращает текст первого кандидата'''
+    gemini_path = f'/v1beta/models/gemini-2.0-flash-exp:generateContent?key={api_key}'
+    gemini_response = call_gemini('POST', gemini_path, {'contents': [{'parts': [{'text': prompt}]}]}, timeout=timeout)
+    
+    if 'candidates' in gemini_response and gemini_response['candidates']:
+        return gemini_response['candidates'][0]['content']['parts'][0]['text'].strip()
+    raise ValueError('Не удалось получить ответ от Gemini')
+
+
+def estimate_pages(chars: int) -> int:
+    '''Оценивает число страниц А4 по количеству символов'''
+    return max(1, math.ceil(chars / CHARS_PER_PAGE))
+
+
+def split_paragraphs(text: str) -> list:
+    return [line.strip() for line in text.split('\n') if line.strip()]
+
+
+class MarkdownWriter:
+    '''Пишет документ в Markdown по мере поступления разделов'''
+    
+    def __init__(self, path: str):
+        self.file = open(path, 'w', encoding='utf-8')
+    
+    def begin(self, title: str, subtitle: str, toc: list):
+        self.file.write(f'# {title}\n\n_{subtitle}_\n\n## Содержание\n\n')
+        for i, (section_title, page) in enumerate(toc):
+            self.file.write(f'{i + 1}. [{section_title}](#section-{i + 1}) — стр. {page}\n')
+        self.file.write('\n')
+    
+    def add_section(self, index: int, title: str, text: str):
+        self.file.write(f'<a id="section-{index + 1}"></a>\n\n## {title}\n\n')
+        for paragraph in split_paragraphs(text):
+            self.file.write(paragraph + '\n\n')
+    
+    def finish(self):
+        self.close()
+    
+    def close(self):
+        self.file.close()
+
+
+class HtmlWriter:
+    '''Пишет HTML, готовый к печати в PDF из браузера'''
+    
+    def __init__(self, path: str):
+        self.file = open(path, 'w', encoding='utf-8')
+    
+    def begin(self, title: str, subtitle: str, toc: list):
+        self.file.write(
+            '<!DOCTYPE html>\n<html lang="ru">\n<head>\n<meta charset="utf-8">\n'
+            f'<title>{html.escape(title)}</title>\n'
+            '<style>\n'
+            '@page { size: A4; margin: 2cm 1.5cm 2cm 3cm; }\n'
+            'body { font-family: "Times New Roman", serif; font-size: 14pt; line-height: 1.5; }\n'
+            'p { text-indent: 1.25cm; margin: 0; text-align: justify; }\n'
+            'h2 { page-break-before: always; text-align: center; }\n'
+            '.toc li { display: flex; }\n'
+            '.toc .dots { flex: 1; border-bottom: 1px dotted #000; margin: 0 4px 5px; }\n'
+            '</style>\n</head>\n<body>\n'
+            f'<h1>{html.escape(title)}</h1>\n<p>{html.escape(subtitle)}</p>\n'
+            '<nav class="toc"><h3>Содержание</h3><ol>\n'
+        )
+        for i, (section_title, page) in enumerate(toc):
+            self.file.write(
+                f'<li><a href="#section-{i + 1}">{html.escape(section_title)}</a>'
+                f'<span class="dots"></span><span>{page}</span></li>\n'
+            )
+        self.file.write('</ol></nav>\n')
+    
+    def add_section(self, index: int, title: str, text: str):
+        self.file.write(f'<h2 id="section-{index + 1}">{html.escape(title)}</h2>\n')
+        for paragraph in split_paragraphs(text):
+            self.file.write(f'<p>{html.escape(paragraph)}</p>\n')
+    
+    def finish(self):
+        self.file.write('</body>\n</html>\n')
+        self.close()
+    
+    def close(self):
+        self.file.close()
+
+
+class DocxWriter:
+    '''Пишет DOCX, потоково дописывая word/document.xml внутри архива'''
+    
+    CONTENT_TYPES = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+        '<Override PartName="/word/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>'
+        '</Types>'
+    )
+    
+    RELS = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+        '</Relationships>'
+    )
+    
+    DOCUMENT_RELS = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+        '</Relationships>'
+    )
+    
+    STYLES = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<w:styles xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+        '<w:docDefaults><w:rPrDefault><w:rPr>'
+        '<w:rFonts w:ascii="Times New Roman" w:hAnsi="Times New Roman" w:cs="Times New Roman"/>'
+        '<w:sz w:val="28"/><w:lang w:val="ru-RU"/></w:rPr></w:rPrDefault>'
+        '<w:pPrDefault><w:pPr><w:spacing w:after="0" w:line="360" w:lineRule="auto"/></w:pPr></w:pPrDefault>'
+        '</w:docDefaults>'
+        '<w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/>'
+        '<w:pPr><w:ind w:firstLine="709"/><w:jc w:val="both"/></w:pPr></w:style>'
+        '<w:style w:type="paragraph" w:styleId="Title"><w:name w:val="Title"/><w:basedOn w:val="Normal"/>'
+        '<w:pPr><w:ind w:firstLine="0"/><w:jc w:val="center"/></w:pPr><w:rPr><w:b/><w:sz w:val="32"/></w:rPr></w:style>'
+        '<w:style w:type="paragraph" w:styleId="Heading1"><w:name w:val="heading 1"/><w:basedOn w:val="Normal"/>'
+        '<w:pPr><w:keepNext/><w:pageBreakBefore/><w:spacing w:after="240"/><w:ind w:firstLine="0"/>'
+        '<w:jc w:val="center"/><w:outlineLvl w:val="0"/></w:pPr><w:rPr><w:b/></w:rPr></w:style>'
+        '<w:style w:type="paragraph" w:styleId="TOC1"><w:name w:val="toc 1"/><w:basedOn w:val="Normal"/>'
+        '<w:pPr><w:tabs><w:tab w:val="right" w:leader="dot" w:pos="9345"/></w:tabs><w:ind w:firstLine="0"/></w:pPr></w:style>'
+        '</w:styles>'
+    )
+    
+    def __init__(self, path: str):
+        self.archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        self.archive.writestr('[Content_Types].xml', self.CONTENT_TYPES)
+        self.archive.writestr('_rels/.rels', self.RELS)
+        self.archive.writestr('word/_rels/document.xml.rels', self.DOCUMENT_RELS)
+        self.archive.writestr('word/styles.xml', self.STYLES)
+        self.stream = self.archive.open('word/document.xml', 'w')
+    
+    def write(self, chunk: str):
+        self.stream.write(chunk.encode('utf-8'))
+    
+    def paragraph(self, text: str, style: str = '', extra_runs: str = ''):
+        style_xml = f'<w:pPr><w:pStyle w:val="{style}"/></w:pPr>' if style else ''
+        self.write(
+            f'<w:p>{style_xml}<w:r><w:t xml:space="preserve">{xml_escape(text)}</w:t></w:r>{extra_runs}</w:p>'
+        )
+    
+    def begin(self, title: str, subtitle: str, toc: list):
+        self.write(
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+        )
+        self.paragraph(title, 'Title')
+        self.paragraph(subtitle, 'Title')
+        self.paragraph('Содержание', 'Title')
+        for section_title, page in toc:
+            self.paragraph(section_title, 'TOC1', f'<w:r><w:tab/><w:t>{page}</w:t></w:r>')
+    
+    def add_section(self, index: int, title: str, text: str):
+        self.paragraph(title, 'Heading1')
+        for paragraph in split_paragraphs(text):
+            self.paragraph(paragraph)
+    
+    def finish(self):
+        self.write(
+            '<w:sectPr><w:pgSz w:w="11906" w:h="16838"/>'
+            '<w:pgMar w:top="1134" w:right="850" w:bottom="1134" w:left="1701" w:header="708" w:footer="708" w:gutter="0"/>'
+            '</w:sectPr></w:body></w:document>'
+        )
+        self.close()
+    
+    def close(self):
+        self.stream.close()
+        self.archive.close()
+
+
+EXPORT_WRITERS = {
+    'docx': DocxWriter,
+    'markdown': MarkdownWriter,
+    'html': HtmlWriter,
+    'pdf': HtmlWriter
+}
+
+
+def get_s3_client():
+    '''Возвращает общий для всех вызовов контейнера клиент хранилища'''
+    if WARM_STATE.get('s3') is None:
+        WARM_STATE['s3'] = boto3.client(
+            's3',
+            endpoint_url='https://bucket.poehali.dev',
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
+        )
+    return WARM_STATE['s3']
+
+
+def export_document(body: dict, api_key: str, client_id: str) -> dict:
+    '''Собирает документ в выбранном формате по разделам и сохраняет файл в хранилище'''
+    export_format = body.get('format', 'docx')
+    doc_type = body.get('docType', 'реферат')
+    subject = body.get('subject', '')
+    pages = body.get('pages', 10)
+    topics = body.get('topics', [])
+    additional_info = body.get('additionalInfo', '')
+    sections = body.get('sections') or (
+        [{'title': 'Введение', 'description': f'Введение к {doc_type} на тему "{subject}"'}]
+        + topics
+        + [{'title': 'Заключение', 'description': f'Заключение к {doc_type} на тему "{subject}"'}]
+        if isinstance(topics, list) else None
+    )
+    max_sections = pages + 2
+    
+    if export_format not in EXPORT_WRITERS:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': f'Неподдерживаемый формат: {export_format}'}, ensure_ascii=False),
+            'isBase64Encoded': False
+        }
+    
+    if (not isinstance(sections, list) or len(sections) > max_sections
+            or any(not isinstance(section, dict) or not isinstance(section.get('title'), str)
+                   or not section['title'].strip() or not isinstance(section.get('text') or '', str)
+                   for section in sections)):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({
+                'error': f'Разделы должны быть объектами с названием, не более {max_sections} на {pages} стр.'
+            }, ensure_ascii=False),
+            'isBase64Encoded': False
+        }
+    
+    if any(not section.get('text') for section in sections) and not api_key:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'API ключ не настроен'}),
+            'isBase64Encoded': False
+        }
+    
+    sections_count = len(topics) or 5
+    prompts = {}
+    for i, section in enumerate(sections):
+        if not section.get('text'):
+            prompt = build_section_prompt(doc_type, subject, section['title'], section.get('description', ''),
+                                          additional_info, pages, sections_count)
+            output_tokens = math.ceil(
+                section_target_words(section['title'], pages, sections_count) * OUTPUT_TOKENS_PER_WORD
+            )
+            prompts[i] = (prompt, estimate_tokens(prompt), output_tokens)
+    
+    for prompt, prompt_tokens, output_tokens in prompts.values():
+        rejection = check_request_limits(prompt_tokens, output_tokens)
+        if rejection:
+            return rejection_response(rejection)
+    
+    batch_prompt_tokens = sum(prompt_tokens for _, prompt_tokens, _ in prompts.values())
+    batch_output_tokens = sum(output_tokens for _, _, output_tokens in prompts.values())
+    rejection = (check_batch_limits(batch_prompt_tokens, batch_output_tokens)
+                 or check_daily_budget(client_id, batch_prompt_tokens, batch_output_tokens))
+    if rejection:
+        if rejection['statusCode'] == 413:
+            rejection['split'] = {'mode': 'section', 'sections': [sections[i]['title'] for i in prompts]}
+        return rejection_response(rejection)
+    
+    toc = []
+    page = 2
+    for section in sections:
+        toc.append((section['title'], page))
+        page += estimate_pages(
+            len(section['text']) if section.get('text')
+            else section_target_words(section['title'], pages, sections_count) * CHARS_PER_WORD
+        )
+    page_count = page - 1
+    
+    extension, content_type = EXPORT_FORMATS[export_format]
+    file_name = f'{doc_type}_{subject[:30]}.{extension}'
+    fd, path = tempfile.mkstemp(suffix=f'.{extension}')
+    os.close(fd)
+    
+    writer = None
+    deadline = time.monotonic() + EXPORT_RUN_SECONDS
+    try:
+        writer = EXPORT_WRITERS[export_format](path)
+        writer.begin(doc_type.upper(), f'Тема: {subject}', toc)
+        for i, section in enumerate(sections):
+            text = section.get('text')
+            if i in prompts:
+                remaining = deadline - time.monotonic()
+                if remaining < 1:
+                    return {
+                        'statusCode': 504,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({
+                            'error': 'Не хватило времени на генерацию всех разделов, '
+                                     'сгенерируйте оставшиеся в режиме section и повторите экспорт с их текстом',
+                            'completed': [item['title'] for item in sections[:i]],
+                            'pending': [item['title'] for item in sections[i:] if not item.get('text')]
+                        }, ensure_ascii=False),
+                        'isBase64Encoded': False
+                    }
+                prompt, prompt_tokens, output_tokens = prompts[i]
+                record_usage(client_id, prompt_tokens, output_tokens)
+                text = generate_text(prompt, api_key, timeout=min(20, remaining))
+            writer.add_section(i, section['title'], text)
+        writer.finish()
+        
+        result = {
+            'format': export_format,
+            'fileName': file_name,
+            'contentType': content_type,
+            'pageCount': page_count,
+            'toc': [{'title': title, 'page': page} for title, page in toc]
+        }
+        
+        if os.environ.get('AWS_ACCESS_KEY_ID'):
+            key = f'documents/{uuid.uuid4()}.{extension}'
+            get_s3_client().upload_file(path, 'files', key, ExtraArgs={'ContentType': content_type})
+            result['url'] = f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{key}"
+        elif os.path.getsize(path) > EXPORT_INLINE_MAX_BYTES:
+            return {
+                'statusCode': 413,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Файл слишком большой для передачи в ответе, настройте хранилище'}, ensure_ascii=False),
+                'isBase64Encoded': False
+            }
+        else:
+            with open(path, 'rb') as f:
+                result['file'] = base64.b64encode(f.read()).decode('ascii')
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps(result, ensure_ascii=False),
+            'isBase64Encoded': False
+        }
+    finally:
+        if writer:
+            writer.close()
+        os.remove(path)
+
 
 def handler(event: dict, context) -> dict:
     '''Генерирует структуру или полный документ с помощью Gemini API'''
     
     method = event.get('httpMethod', 'POST')
     
+    WARM_STATE['invocations'] += 1
+    action = (event.get('queryStringParameters') or {}).get('action', '')
+    
+    if action in ('prewarm', 'health'):
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps(prewarm() if action == 'prewarm' else health_report()),
+            'isBase64Encoded': False
+        }
+    
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
                 'Access-Control-Allow-Headers': 'Content-Type',
                 'Access-Control-Max-Age': '86400'
             },
@@ -48,6 +694,14 @@ def handler(event: dict, context) -> dict:
                 'isBase64Encoded': False
             }
         
+        if isinstance(pages, bool) or not isinstance(pages, int) or not 1 <= pages <= MAX_PAGES:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': f'Количество страниц должно быть целым числом от 1 до {MAX_PAGES}'}, ensure_ascii=False),
+                'isBase64Encoded': False
+            }
+        
         if mode == 'section' and not section_title:
             return {
                 'statusCode': 400,
@@ -57,7 +711,9 @@ def handler(event: dict, context) -> dict:
             }
         
         api_key = os.environ.get('GEMINI_API_KEY')
-        proxy_url = os.environ.get('PROXY_URL')
+        
+        if mode == 'export':
+            return export_document(body, api_key, get_client_id(event))
         
         if not api_key:
             return {
@@ -69,6 +725,7 @@ def handler(event: dict, context) -> dict:
         
         if mode == 'topics':
             sections_count = max(3, pages // 3)
+            output_words = sections_count * 60
             prompt = f"""Создай структуру для документа типа "{doc_type}" на тему: {subject}
 
 Документ должен быть объемом примерно {pages} страниц А4.
@@ -88,43 +745,16 @@ def handler(event: dict, context) -> dict:
 
 ВАЖНО: Верни ТОЛЬКО JSON, без дополнительного текста, markdown или комментариев!"""
         elif mode == 'section':
-            words_per_page = 300
-            total_words_needed = pages * words_per_page
-            sections_count = len(topics) if topics else 5
-            words_for_intro_conclusion = 400
-            words_for_sections = total_words_needed - words_for_intro_conclusion
-            words_per_section = words_for_sections // sections_count if sections_count > 0 else 500
-            
-            target_words = words_per_section
-            if 'введение' in section_title.lower() or 'заключение' in section_title.lower():
-                target_words = 200
-            
-            prompt = f"""Напиши раздел для академического документа ({doc_type}) на тему: {subject}
-
-РАЗДЕЛ: {section_title}
-ОПИСАНИЕ: {section_description}
-
-КРИТИЧНЫЕ ТРЕБОВАНИЯ:
-- Объем: СТРОГО {target_words} слов (это обязательно!)
-- Академический стиль, научная терминология
-- Логичное изложение с примерами и деталями
-- Раскрывай тему МАКСИМАЛЬНО подробно
-- Используй абзацы для структуры
-- Приводи конкретные примеры и факты
-- Пиши развернуто, не сокращай
-
-{f'Дополнительные требования: {additional_info}' if additional_info else ''}
-
-ВАЖНО: Текст должен быть РОВНО {target_words} слов! Не меньше!
-Напиши ТОЛЬКО текст раздела, без заголовка раздела."""
+            prompt = build_section_prompt(doc_type, subject, section_title, section_description,
+                                          additional_info, pages, len(topics) if topics else 5)
+            output_words = section_target_words(section_title, pages, len(topics) if topics else 5)
         else:
             topics_structure = '\n'.join([
                 f"{i+1}. {topic['title']}\n   {topic['description']}"
                 for i, topic in enumerate(topics)
             ])
             
-            chars_per_page = 1800
-            target_chars = pages * chars_per_page
+            target_chars = pages * CHARS_PER_PAGE
             chars_per_section = target_chars // len(topics)
             
             words_per_page = 300
@@ -132,6 +762,7 @@ def handler(event: dict, context) -> dict:
             words_per_section = target_words // len(topics)
             
             words_limit = min(target_words, 2000)
+            output_words = words_limit
             
             prompt = f"""Напиши академический {doc_type} на тему: {subject}
 
@@ -164,7 +795,31 @@ def handler(event: dict, context) -> dict:
 
 КРИТИЧНО: Уложись в {words_limit} слов! Пиши только главное."""
 
-        gemini_url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp:generateContent?key={api_key}'
+        client_id = get_client_id(event)
+        prompt_tokens = estimate_tokens(prompt)
+        output_tokens = math.ceil(output_words * OUTPUT_TOKENS_PER_WORD)
+        rejection = admit_request(client_id, prompt_tokens, output_tokens)
+        if rejection:
+            if mode == 'document' and rejection['statusCode'] == 413:
+                split_sections = (
+                    [{'title': 'Введение', 'description': f'Введение к {doc_type} на тему "{subject}"'}]
+                    + topics
+                    + [{'title': 'Заключение', 'description': f'Заключение к {doc_type} на тему "{subject}"'}]
+                )
+                fits = all(
+                    not check_request_limits(
+                        estimate_tokens(build_section_prompt(doc_type, subject, section['title'], section['description'],
+                                                             additional_info, pages, len(topics))),
+                        math.ceil(section_target_words(section['title'], pages, len(topics)) * OUTPUT_TOKENS_PER_WORD)
+                    )
+                    for section in split_sections
+                )
+                if fits:
+                    rejection['split'] = {'mode': 'section', 'sections': [section['title'] for section in split_sections]}
+            return rejection_response(rejection)
+        record_usage(client_id, prompt_tokens, output_tokens)
+        
+        gemini_path = f'/v1beta/models/gemini-2.0-flash-exp:generateContent?key={api_key}'
         
         gemini_request = {
             'contents': [{
@@ -172,20 +827,8 @@ def handler(event: dict, context) -> dict:
             }]
         }
         
-        req = urllib.request.Request(
-            gemini_url,
-            data=json.dumps(gemini_request).encode('utf-8'),
-            headers={'Content-Type': 'application/json'}
-        )
-        
-        if proxy_url:
-            proxy_handler = urllib.request.ProxyHandler({'http': proxy_url, 'https': proxy_url})
-            opener = urllib.request.build_opener(proxy_handler)
-            urllib.request.install_opener(opener)
-        
         try:
-            with urllib.request.urlopen(req, timeout=20) as response:
-                gemini_response = json.loads(response.read().decode('utf-8'))
+            gemini_response = call_gemini('POST', gemini_path, gemini_request, timeout=20)
         except Exception as timeout_err:
             return {
                 'statusCode': 500,
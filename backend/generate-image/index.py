@@ -1,20 +1,128 @@
 import json
 import os
-import urllib.request
+import io
+import threading
+import time
+import http.client
+import urllib.parse
 import urllib.error
 import base64
 
+GEMINI_HOST = 'generativelanguage.googleapis.com'
+
+WARM_STATE = {
+    'loaded_at': time.time(),
+    'warmed_at': None,
+    'invocations': 0,
+    'connections': [],
+    'lock': threading.Lock(),
+    'checks': {}
+}
+
+
+def open_gemini_connection() -> http.client.HTTPSConnection:
+    '''Открывает keep-alive соединение с Gemini, при наличии PROXY_URL через CONNECT-туннель'''
+    proxy_url = os.environ.get('PROXY_URL')
+    if not proxy_url:
+        return http.client.HTTPSConnection(GEMINI_HOST, 443)
+    proxy = urllib.parse.urlparse(proxy_url)
+    conn = http.client.HTTPSConnection(proxy.hostname, proxy.port or (443 if proxy.scheme == 'https' else 80))
+    tunnel_headers = {}
+    if proxy.username:
+        credentials = f'{urllib.parse.unquote(proxy.username)}:{urllib.parse.unquote(proxy.password or "")}'
+        tunnel_headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+    conn.set_tunnel(GEMINI_HOST, 443, tunnel_headers)
+    return conn
+
+
+def call_gemini(method: str, path: str, payload: dict = None, timeout: float = 20) -> dict:
+    '''Выполняет запрос к Gemini через пул соединений контейнера и возвращает JSON-ответ'''
+    body = json.dumps(payload).encode('utf-8') if payload is not None else None
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    for attempt in range(2):
+        with WARM_STATE['lock']:
+            conn = WARM_STATE['connections'].pop() if WARM_STATE['connections'] else None
+        reused = conn is not None
+        conn = conn or open_gemini_connection()
+        conn.timeout = timeout
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            data = response.read()
+        except ConnectionError:
+            conn.close()
+            # Простаивавшее соединение могло быть закрыто сервером — повторяем один раз на новом
+            if reused and attempt == 0:
+                continue
+            raise
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            with WARM_STATE['lock']:
+                WARM_STATE['connections'].append(conn)
+        if response.status >= 400:
+            raise urllib.error.HTTPError(f'https://{GEMINI_HOST}{path.split("?")[0]}', response.status, response.reason, response.headers, io.BytesIO(data))
+        return json.loads(data.decode('utf-8'))
+
+
+def run_check(check) -> dict:
+    started = time.monotonic()
+    try:
+        check()
+        return {'ok': True, 'ms': round((time.monotonic() - started) * 1000)}
+    except Exception as e:
+        return {'ok': False, 'ms': round((time.monotonic() - started) * 1000), 'error': str(e)}
+
+
+def health_report() -> dict:
+    '''Состояние прогрева контейнера для планировщика'''
+    now = time.time()
+    warmed_at = WARM_STATE['warmed_at']
+    return {
+        'ready': warmed_at is not None and bool(os.environ.get('GEMINI_API_KEY')) and all(check['ok'] for check in WARM_STATE['checks'].values()),
+        'warm': warmed_at is not None,
+        'warmAgeSeconds': round(now - warmed_at, 1) if warmed_at else None,
+        'uptimeSeconds': round(now - WARM_STATE['loaded_at'], 1),
+        'invocations': WARM_STATE['invocations'],
+        'checks': WARM_STATE['checks']
+    }
+
+
+def prewarm() -> dict:
+    '''Прогревает контейнер: открывает соединение с Gemini в пуле и локальные кэши'''
+    api_key = os.environ.get('GEMINI_API_KEY', '')
+    checks = {'gemini': run_check(lambda: call_gemini('GET', f'/v1beta/models?pageSize=1&key={api_key}', timeout=10))}
+    WARM_STATE['checks'] = checks
+    WARM_STATE['warmed_at'] = time.time()
+    return health_report()
+
+
 def handler(event: dict, context) -> dict:
     '''API для генерации изображений через Gemini 2.5 Flash с использованием прокси'''
     
     method = event.get('httpMethod', 'GET')
     
+    WARM_STATE['invocations'] += 1
+    action = (event.get('queryStringParameters') or {}).get('action', '')
+    
+    if action in ('prewarm', 'health'):
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps(prewarm() if action == 'prewarm' else health_report())
+        }
+    
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
                 'Access-Control-Allow-Headers': 'Content-Type',
                 'Access-Control-Max-Age': '86400'
             },
@@ -71,7 +179,6 @@ def handler(event: dict, context) -> dict:
         prompt = f"{task}. Style: {style_instruction}. Aspect ratio: {aspect_instruction}. High quality, detailed."
         
         gemini_api_key = os.environ.get('GEMINI_API_KEY')
-        proxy_url = os.environ.get('PROXY_URL')
         
         if not gemini_api_key:
             return {
@@ -80,7 +187,7 @@ def handler(event: dict, context) -> dict:
                 'body': json.dumps({'error': 'GEMINI_API_KEY не настроен'})
             }
         
-        gemini_url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-image:generateContent?key={gemini_api_key}'
+        gemini_path = f'/v1beta/models/gemini-2.5-flash-image:generateContent?key={gemini_api_key}'
         
         gemini_request = {
             'contents': [{
@@ -88,19 +195,7 @@ def handler(event: dict, context) -> dict:
             }]
         }
         
-        req = urllib.request.Request(
-            gemini_url,
-            data=json.dumps(gemini_request).encode('utf-8'),
-            headers={'Content-Type': 'application/json'}
-        )
-        
-        if proxy_url:
-            proxy_handler = urllib.request.ProxyHandler({'http': proxy_url, 'https': proxy_url})
-            opener = urllib.request.build_opener(proxy_handler)
-            urllib.request.install_opener(opener)
-        
-        with urllib.request.urlopen(req, timeout=60) as response:
-            gemini_response = json.loads(response.read().decode('utf-8'))
+        gemini_response = call_gemini('POST', gemini_path, gemini_request, timeout=60)
         
         if 'candidates' in gemini_response and len(gemini_response['candidates']) > 0:
             parts = gemini_response['candidates'][0]['content']['parts']
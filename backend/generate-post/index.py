@@ -1,19 +1,605 @@
 import json
 import os
-import urllib.request
+import math
+import base64
+import io
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import http.client
+import urllib.parse
 import urllib.error
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# По умолчанию календарь живёт в /tmp контейнера; для resume после масштабирования укажите общий путь
+CALENDAR_DB_PATH = os.environ.get('CALENDAR_DB_PATH', '/tmp/content_calendar.db')
+CALENDAR_WORKERS = int(os.environ.get('CALENDAR_WORKERS', '8'))
+CALENDAR_RPM = int(os.environ.get('CALENDAR_RPM', '120'))
+CALENDAR_RUN_SECONDS = int(os.environ.get('CALENDAR_RUN_SECONDS', '25'))
+CALENDAR_CLAIM_SECONDS = CALENDAR_RUN_SECONDS + 60
+
+SLOT_FIELDS = ('date', 'platform', 'task', 'tone', 'goal', 'length', 'emojis')
+SLOT_DEFAULTS = {
+    'platform': 'социальная сеть',
+    'tone': 'дружелюбный',
+    'goal': 'вовлечение',
+    'length': 'средний',
+    'emojis': 'баланс'
+}
+
+GEMINI_HOST = 'generativelanguage.googleapis.com'
+
+WARM_STATE = {
+    'loaded_at': time.time(),
+    'warmed_at': None,
+    'invocations': 0,
+    'connections': [],
+    'lock': threading.Lock(),
+    'checks': {}
+}
+
+
+def open_gemini_connection() -> http.client.HTTPSConnection:
+    '''Открывает keep-alive соединение с Gemini, при наличии PROXY_URL через CONNECT-туннель'''
+    proxy_url = os.environ.get('PROXY_URL')
+    if not proxy_url:
+        return http.client.HTTPSConnection(GEMINI_HOST, 443)
+    proxy = urllib.parse.urlparse(proxy_url)
+    conn = http.client.HTTPSConnection(proxy.hostname, proxy.port or (443 if proxy.scheme == 'https' else 80))
+    tunnel_headers = {}
+    if proxy.username:
+        credentials = f'{urllib.parse.unquote(proxy.username)}:{urllib.parse.unquote(proxy.password or "")}'
+        tunnel_headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+    conn.set_tunnel(GEMINI_HOST, 443, tunnel_headers)
+    return conn
+
+
+def call_gemini(method: str, path: str, payload: dict = None, timeout: float = 20) -> dict:
+    '''Выполняет запрос к Gemini через пул соединений контейнера и возвращает JSON-ответ'''
+    body = json.dumps(payload).encode('utf-8') if payload is not None else None
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    for attempt in range(2):
+        with WARM_STATE['lock']:
+            conn = WARM_STATE['connections'].pop() if WARM_STATE['connections'] else None
+        reused = conn is not None
+        conn = conn or open_gemini_connection()
+        conn.timeout = timeout
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            data = response.read()
+        except ConnectionError:
+            conn.close()
+            # Простаивавшее соединение могло быть закрыто сервером — повторяем один раз на новом
+            if reused and attempt == 0:
+                continue
+            raise
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            with WARM_STATE['lock']:
+                WARM_STATE['connections'].append(conn)
+        if response.status >= 400:
+            raise urllib.error.HTTPError(f'https://{GEMINI_HOST}{path.split("?")[0]}', response.status, response.reason, response.headers, io.BytesIO(data))
+        return json.loads(data.decode('utf-8'))
+
+
+def run_check(check) -> dict:
+    started = time.monotonic()
+    try:
+        check()
+        return {'ok': True, 'ms': round((time.monotonic() - started) * 1000)}
+    except Exception as e:
+        return {'ok': False, 'ms': round((time.monotonic() - started) * 1000), 'error': str(e)}
+
+
+def health_report() -> dict:
+    '''Состояние прогрева контейнера для планировщика'''
+    now = time.time()
+    warmed_at = WARM_STATE['warmed_at']
+    return {
+        'ready': warmed_at is not None and bool(os.environ.get('GEMINI_API_KEY')) and all(check['ok'] for check in WARM_STATE['checks'].values()),
+        'warm': warmed_at is not None,
+        'warmAgeSeconds': round(now - warmed_at, 1) if warmed_at else None,
+        'uptimeSeconds': round(now - WARM_STATE['loaded_at'], 1),
+        'invocations': WARM_STATE['invocations'],
+        'checks': WARM_STATE['checks']
+    }
+
+
+def prewarm() -> dict:
+    '''Прогревает контейнер: открывает соединение с Gemini в пуле и локальные кэши'''
+    api_key = os.environ.get('GEMINI_API_KEY', '')
+    checks = {'gemini': run_check(lambda: call_gemini('GET', f'/v1beta/models?pageSize=1&key={api_key}', timeout=10))}
+    checks['calendar'] = run_check(lambda: open_calendar_db().close())
+    checks['ledger'] = run_check(get_ledger)
+    WARM_STATE['checks'] = checks
+    WARM_STATE['warmed_at'] = time.time()
+    return health_report()
+
+
+TOKEN_LEDGER_PATH = os.environ.get('TOKEN_LEDGER_PATH', '/tmp/token_ledger.db')
+MAX_PROMPT_TOKENS = int(os.environ.get('MAX_PROMPT_TOKENS', '4000'))
+MAX_OUTPUT_TOKENS = int(os.environ.get('MAX_OUTPUT_TOKENS', '10000'))
+MAX_REQUEST_COST_USD = float(os.environ.get('MAX_REQUEST_COST_USD', '0.005'))
+CLIENT_DAILY_TOKENS = int(os.environ.get('CLIENT_DAILY_TOKENS', '200000'))
+INPUT_TOKEN_PRICE_USD = float(os.environ.get('INPUT_TOKEN_PRICE_USD', '0.10')) / 1_000_000
+OUTPUT_TOKEN_PRICE_USD = float(os.environ.get('OUTPUT_TOKEN_PRICE_USD', '0.40')) / 1_000_000
+OUTPUT_CHARS_PER_TOKEN = 2.5
+
+LENGTH_OUTPUT_CHARS = {
+    'короткий': 200,
+    'средний': 500,
+    'длинный': 1500
+}
+
+TOKEN_PATTERNS = (
+    (re.compile(r'[A-Za-z]+'), 4.0),
+    (re.compile(r'[А-Яа-яЁё]+'), 2.5),
+    (re.compile(r'\d+'), 3.0),
+    (re.compile(r'[^\sA-Za-zА-Яа-яЁё\d]'), 1.0)
+)
+
+
+def estimate_tokens(text: str) -> int:
+    '''Быстро оценивает число токенов Gemini для русского и английского текста'''
+    tokens = 0
+    for pattern, chars_per_token in TOKEN_PATTERNS:
+        for match in pattern.findall(text):
+            tokens += math.ceil(len(match) / chars_per_token)
+    return tokens
+
+
+def get_client_id(event: dict) -> str:
+    '''Определяет клиента для учёта токенов: пользователь из авторизатора шлюза или IP источника'''
+    request_context = event.get('requestContext') or {}
+    authorizer = request_context.get('authorizer') or {}
+    user_id = authorizer.get('principalId') or (authorizer.get('claims') or {}).get('sub')
+    if user_id:
+        return f'user:{user_id}'
+    source_ip = (request_context.get('identity') or {}).get('sourceIp')
+    return f'ip:{source_ip}' if source_ip else 'anonymous'
+
+
+def get_ledger() -> sqlite3.Connection:
+    '''Возвращает общий для всех вызовов контейнера журнал расхода токенов'''
+    if WARM_STATE.get('ledger') is None:
+        conn = sqlite3.connect(TOKEN_LEDGER_PATH, check_same_thread=False)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS token_usage (
+                client_id TEXT NOT NULL,
+                day TEXT NOT NULL,
+                requests INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                output_tokens INTEGER NOT NULL DEFAULT 0,
+                cost_usd REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (client_id, day)
+            )
+        ''')
+        WARM_STATE['ledger'] = conn
+    return WARM_STATE['ledger']
+
+
+def record_usage(client_id: str, prompt_tokens: int, output_tokens: int):
+    if prompt_tokens < 0 or output_tokens < 0:
+        raise ValueError('Число токенов не может быть отрицательным')
+    cost = prompt_tokens * INPUT_TOKEN_PRICE_USD + output_tokens * OUTPUT_TOKEN_PRICE_USD
+    ledger = get_ledger()
+    ledger.execute(
+        '''INSERT INTO token_usage (client_id, day, requests, prompt_tokens, output_tokens, cost_usd)
+           VALUES (?, date('now'), 1, ?, ?, ?)
+           ON CONFLICT (client_id, day) DO UPDATE SET
+               requests = requests + 1,
+               prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+               output_tokens = output_tokens + excluded.output_tokens,
+               cost_usd = cost_usd + excluded.cost_usd''',
+        (client_id, prompt_tokens, output_tokens, cost)
+    )
+    ledger.commit()
+
+
+def usage_estimate(prompt_tokens: int, output_tokens: int) -> dict:
+    if prompt_tokens < 0 or output_tokens < 0:
+        raise ValueError('Число токенов не может быть отрицательным')
+    cost = prompt_tokens * INPUT_TOKEN_PRICE_USD + output_tokens * OUTPUT_TOKEN_PRICE_USD
+    return {'promptTokens': prompt_tokens, 'outputTokens': output_tokens, 'costUsd': round(cost, 6)}
+
+
+def check_request_limits(prompt_tokens: int, output_tokens: int) -> dict:
+    '''Проверяет один вызов по лимитам токенов и стоимости, возвращает описание отказа или None'''
+    if prompt_tokens > MAX_PROMPT_TOKENS:
+        return {'statusCode': 413, 'error': 'Слишком длинный запрос, сократите описание или дополнительные требования',
+                'estimate': usage_estimate(prompt_tokens, output_tokens), 'limit': MAX_PROMPT_TOKENS}
+    return check_batch_limits(prompt_tokens, output_tokens)
+
+
+def check_batch_limits(prompt_tokens: int, output_tokens: int) -> dict:
+    '''Проверяет суммарный объем генерации и стоимость одного вызова функции'''
+    estimate = usage_estimate(prompt_tokens, output_tokens)
+    if output_tokens > MAX_OUTPUT_TOKENS or estimate['costUsd'] > MAX_REQUEST_COST_USD:
+        return {'statusCode': 413, 'error': 'Слишком большой объем генерации за один запрос',
+                'estimate': estimate, 'limit': MAX_OUTPUT_TOKENS}
+    return None
+
+
+def remaining_daily_tokens(client_id: str) -> int:
+    used = get_ledger().execute(
+        "SELECT prompt_tokens + output_tokens FROM token_usage WHERE client_id = ? AND day = date('now')",
+        (client_id,)
+    ).fetchone()
+    return CLIENT_DAILY_TOKENS - (used[0] if used else 0)
+
+
+def check_daily_budget(client_id: str, prompt_tokens: int, output_tokens: int) -> dict:
+    remaining = remaining_daily_tokens(client_id)
+    if prompt_tokens + output_tokens > remaining:
+        return {'statusCode': 429, 'error': 'Дневной лимит токенов исчерпан',
+                'estimate': usage_estimate(prompt_tokens, output_tokens),
+                'used': CLIENT_DAILY_TOKENS - remaining, 'limit': CLIENT_DAILY_TOKENS}
+    return None
+
+
+def admit_request(client_id: str, prompt_tokens: int, output_tokens: int) -> dict:
+    '''Проверяет запрос по бюджетам токенов и стоимости, возвращает описание отказа или None'''
+    return check_request_limits(prompt_tokens, output_tokens) or check_daily_budget(client_id, prompt_tokens, output_tokens)
+
+
+def rejection_response(rejection: dict) -> dict:
+    return {
+        'statusCode': rejection.pop('statusCode'),
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(rejection)
+    }
+
+
+def estimate_post_tokens(prompt: str, length: str) -> tuple:
+    return estimate_tokens(prompt), math.ceil(LENGTH_OUTPUT_CHARS.get(length, 500) / OUTPUT_CHARS_PER_TOKEN)
+
+
+def build_post_prompt(platform: str, task: str, tone: str, goal: str, length: str, emojis: str) -> str:
+    '''Собирает промпт для генерации поста под платформу, тон и формат'''
+    
+    platform_names = {
+        'telegram': 'Telegram',
+        'vk': 'ВКонтакте',
+        'instagram': 'Instagram',
+        'facebook': 'Facebook'
+    }
+    
+    length_desc = {
+        'короткий': 'до 200 символов',
+        'средний': '200-500 символов',
+        'длинный': 'более 500 символов'
+    }
+    
+    emoji_desc = {
+        'нет': 'не использовать эмодзи',
+        'мало': 'использовать 1-2 эмодзи',
+        'баланс': 'использовать 3-5 эмодзи',
+        'много': 'использовать много эмодзи (8-12)'
+    }
+    
+    if tone == 'anya_vibe':
+        tone_instruction = '''Пиши в стиле Ани - учителя английского языка и ИИ. 
+Аня ВЕСЕЛАЯ, ПРОСТАЯ, попадает во всякие нелепые ситуации в жизни и учит английскому языку. 
+Она знает английский в СОВЕРШЕНСТВЕ и часто размышляет о нем, делится интересными фактами о языке, грамматике, произношении.
+ЛЮБИТ ШУТИТЬ и веселиться, пишет легко и непринужденно, как будто болтает с другом.
+Делится забавными историями из практики преподавания и изучения языка.
+
+ВАЖНО:
+- Когда используешь английские слова/фразы, ВСЕГДА пиши перевод в скобках сразу после. Пример: "I'm over the moon (на седьмом небе от счастья)"
+- НЕ пиши о принцах, отношениях, парнях, свиданиях, личной жизни
+- Фокусируйся на английском языке, обучении, забавных ситуациях с изучением языка
+- Тон: живой, энергичный, дружелюбный, с юмором и самоиронией'''
+    else:
+        tone_instruction = f'Тон: {tone}'
+    
+    return f"""Создай пост для {platform_names.get(platform, 'социальной сети')}.
+
+Задача: {task}
+
+Требования:
+- {tone_instruction}
+- Цель поста: {goal}
+- Длина: {length_desc.get(length, '200-500 символов')}
+- Эмодзи: {emoji_desc.get(emojis, 'использовать 3-5 эмодзи')}
+
+Напиши готовый пост для {platform_names.get(platform, '')} канала/группы AnyaGPT. Только текст поста, без пояснений."""
+
+
+def generate_post_text(prompt: str, api_key: str, timeout: int = 30) -> str:
+    '''Отправляет промпт в Gemini и возвращает текст поста'''
+    gemini_path = f'/v1beta/models/gemini-2.0-flash-exp:generateContent?key={api_key}'
+    
+    gemini_request = {
+        'contents': [{
+            'parts': [{'text': prompt}]
+        }]
+    }
+    
+    gemini_response = call_gemini('POST', gemini_path, gemini_request, timeout=timeout)
+    
+    if 'candidates' in gemini_response and gemini_response['candidates']:
+        return gemini_response['candidates'][0]['content']['parts'][0]['text']
+    raise ValueError('Не удалось получить ответ от Gemini')
+
+
+class RateLimiter:
+    '''Равномерно распределяет запросы к Gemini в пределах квоты запросов в минуту'''
+    
+    def __init__(self, rpm: int):
+        self.interval = 60.0 / max(1, rpm)
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_at - now
+            self.next_at = max(self.next_at, now) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def open_calendar_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(CALENDAR_DB_PATH)
+    conn.row_factory = sqlite3.Row
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS calendars (
+            id TEXT PRIMARY KEY,
+            created_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS slots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            calendar_id TEXT NOT NULL REFERENCES calendars(id),
+            date TEXT, platform TEXT, task TEXT, tone TEXT, goal TEXT, length TEXT, emojis TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            post TEXT,
+            error TEXT,
+            updated_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS slots_calendar_status ON slots(calendar_id, status);
+    ''')
+    return conn
+
+
+def calendar_summary(conn: sqlite3.Connection, calendar_id: str) -> dict:
+    rows = conn.execute('SELECT * FROM slots WHERE calendar_id = ? ORDER BY date, id', (calendar_id,)).fetchall()
+    slots = [
+        {'id': row['id'], 'status': row['status'], 'post': row['post'], 'error': row['error'],
+         **{field: row[field] for field in SLOT_FIELDS}}
+        for row in rows
+    ]
+    return {
+        'calendarId': calendar_id,
+        'total': len(slots),
+        'done': sum(1 for slot in slots if slot['status'] == 'done'),
+        'failed': sum(1 for slot in slots if slot['status'] == 'error'),
+        'pending': sum(1 for slot in slots if slot['status'] == 'pending'),
+        'running': sum(1 for slot in slots if slot['status'] == 'running'),
+        'slots': slots
+    }
+
+
+def run_calendar(conn: sqlite3.Connection, calendar_id: str, api_key: str, client_id: str,
+                 slot_ids: list = None, overrides: dict = None) -> dict:
+    '''Генерирует незавершённые слоты календаря пулом воркеров в пределах бюджета токенов и времени запуска'''
+    stale_before = time.time() - CALENDAR_CLAIM_SECONDS
+    conn.execute('BEGIN IMMEDIATE')
+    if slot_ids:
+        placeholders = ','.join('?' * len(slot_ids))
+        rows = conn.execute(
+            f"SELECT * FROM slots WHERE calendar_id = ? AND id IN ({placeholders}) "
+            "AND (status != 'running' OR updated_at < ?)",
+            (calendar_id, *slot_ids, stale_before)
+        ).fetchall()
+        if not rows:
+            conn.rollback()
+            return {'statusCode': 409, 'error': 'Слот уже генерируется'}
+        if overrides:
+            conn.execute(
+                f'UPDATE slots SET {", ".join(f"{field} = ?" for field in overrides)} '
+                f'WHERE calendar_id = ? AND id IN ({placeholders})',
+                (*overrides.values(), calendar_id, *slot_ids)
+            )
+            rows = conn.execute(
+                f'SELECT * FROM slots WHERE calendar_id = ? AND id IN ({placeholders})', (calendar_id, *slot_ids)
+            ).fetchall()
+    else:
+        rows = conn.execute(
+            "SELECT * FROM slots WHERE calendar_id = ? "
+            "AND (status IN ('pending', 'error') OR (status = 'running' AND updated_at < ?)) ORDER BY date, id",
+            (calendar_id, stale_before)
+        ).fetchall()
+    
+    remaining_tokens = remaining_daily_tokens(client_id)
+    prompts = {}
+    oversized = []
+    rejection = None
+    batch_prompt_tokens = batch_output_tokens = 0
+    for row in rows:
+        prompt = build_post_prompt(row['platform'], row['task'], row['tone'], row['goal'], row['length'], row['emojis'])
+        prompt_tokens, output_tokens = estimate_post_tokens(prompt, row['length'])
+        slot_rejection = check_request_limits(prompt_tokens, output_tokens)
+        if slot_rejection:
+            oversized.append((slot_rejection['error'], time.time(), row['id']))
+            rejection = slot_rejection if slot_ids else None
+            continue
+        batch_prompt_tokens += prompt_tokens
+        batch_output_tokens += output_tokens
+        batch_rejection = check_batch_limits(batch_prompt_tokens, batch_output_tokens)
+        if not batch_rejection and batch_prompt_tokens + batch_output_tokens > remaining_tokens:
+            batch_rejection = check_daily_budget(client_id, batch_prompt_tokens, batch_output_tokens)
+        if batch_rejection:
+            rejection = None if prompts else batch_rejection
+            break
+        prompts[row['id']] = (prompt, prompt_tokens, output_tokens)
+    
+    conn.executemany("UPDATE slots SET status = 'error', error = ?, updated_at = ? WHERE id = ?", oversized)
+    if not prompts:
+        conn.commit()
+        return rejection
+    
+    rows = [row for row in rows if row['id'] in prompts]
+    previous_status = {row['id']: row['status'] for row in rows}
+    conn.executemany(
+        "UPDATE slots SET status = 'running', updated_at = ? WHERE id = ?",
+        [(time.time(), row['id']) for row in rows]
+    )
+    conn.commit()
+    
+    limiter = RateLimiter(CALENDAR_RPM)
+    deadline = time.monotonic() + CALENDAR_RUN_SECONDS
+    
+    def generate_slot(row):
+        if time.monotonic() >= deadline:
+            return row['id'], None, None
+        limiter.acquire()
+        if time.monotonic() >= deadline:
+            return row['id'], None, None
+        try:
+            timeout = min(30, max(1, deadline - time.monotonic()))
+            return row['id'], generate_post_text(prompts[row['id']][0], api_key, timeout), None
+        except urllib.error.HTTPError as e:
+            return row['id'], None, f'Gemini API error: {e.code}'
+        except Exception as e:
+            return row['id'], None, str(e)
+    
+    with ThreadPoolExecutor(max_workers=CALENDAR_WORKERS) as pool:
+        futures = [pool.submit(generate_slot, row) for row in rows]
+        for future in as_completed(futures):
+            slot_id, post, error = future.result()
+            if post is not None or error is not None:
+                record_usage(client_id, *prompts[slot_id][1:])
+            if post is not None:
+                conn.execute(
+                    "UPDATE slots SET status = 'done', post = ?, error = NULL, updated_at = ? WHERE id = ?",
+                    (post, time.time(), slot_id)
+                )
+            elif error is not None:
+                conn.execute(
+                    "UPDATE slots SET status = 'error', error = ?, updated_at = ? WHERE id = ?",
+                    (error, time.time(), slot_id)
+                )
+            else:
+                conn.execute(
+                    'UPDATE slots SET status = ?, updated_at = ? WHERE id = ?',
+                    (previous_status[slot_id], time.time(), slot_id)
+                )
+            conn.commit()
+    return None
+
+
+def handle_calendar(action: str, request_data: dict, api_key: str, client_id: str) -> dict:
+    '''Создаёт, продолжает, перегенерирует или возвращает контент-календарь'''
+    conn = open_calendar_db()
+    try:
+        calendar_id = request_data.get('calendarId', '')
+        
+        if action == 'calendar':
+            plan = request_data.get('plan', [])
+            defaults = request_data.get('defaults', {})
+            if (not isinstance(plan, list) or not plan or not isinstance(defaults, dict)
+                    or any(not isinstance(slot, dict) or not (slot.get('task') or slot.get('topic')) for slot in plan)):
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'План пуст или у слота не указана задача'})
+                }
+            calendar_id = str(uuid.uuid4())
+            defaults = {**SLOT_DEFAULTS, **defaults}
+            conn.execute('INSERT INTO calendars (id, created_at) VALUES (?, ?)', (calendar_id, time.time()))
+            conn.executemany(
+                f'INSERT INTO slots (calendar_id, {", ".join(SLOT_FIELDS)}) VALUES (?, {", ".join("?" * len(SLOT_FIELDS))})',
+                [
+                    (calendar_id, slot.get('date', ''), slot.get('platform', defaults['platform']),
+                     slot.get('task') or slot.get('topic'), slot.get('tone', defaults['tone']),
+                     slot.get('goal', defaults['goal']), slot.get('length', defaults['length']),
+                     slot.get('emojis', defaults['emojis']))
+                    for slot in plan
+                ]
+            )
+            conn.commit()
+        elif not conn.execute('SELECT 1 FROM calendars WHERE id = ?', (calendar_id,)).fetchone():
+            return {
+                'statusCode': 404,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Календарь не найден'})
+            }
+        
+        if action == 'regenerate':
+            slot_id = request_data.get('slotId')
+            if isinstance(slot_id, bool) or not isinstance(slot_id, int):
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Номер слота должен быть целым числом'})
+                }
+            if any(not isinstance(request_data[field], str) for field in SLOT_FIELDS if field in request_data):
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Поля слота должны быть строками'})
+                }
+            if not conn.execute('SELECT 1 FROM slots WHERE id = ? AND calendar_id = ?', (slot_id, calendar_id)).fetchone():
+                return {
+                    'statusCode': 404,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Слот не найден'})
+                }
+        
+        if action != 'get':
+            if not api_key:
+                return {
+                    'statusCode': 500,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'GEMINI_API_KEY не настроен'})
+                }
+            slot_ids = [request_data['slotId']] if action == 'regenerate' else None
+            overrides = {field: request_data[field] for field in SLOT_FIELDS if field in request_data}
+            rejection = run_calendar(conn, calendar_id, api_key, client_id, slot_ids,
+                                     overrides if action == 'regenerate' else None)
+            if rejection:
+                rejection['calendarId'] = calendar_id
+                return rejection_response(rejection)
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps(calendar_summary(conn, calendar_id))
+        }
+    finally:
+        conn.close()
+
 
 def handler(event: dict, context) -> dict:
     '''API для генерации постов через Gemini 2.5 Flash с использованием прокси'''
     
     method = event.get('httpMethod', 'GET')
     
+    WARM_STATE['invocations'] += 1
+    action = (event.get('queryStringParameters') or {}).get('action', '')
+    
+    if action in ('prewarm', 'health'):
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps(prewarm() if action == 'prewarm' else health_report())
+        }
+    
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
                 'Access-Control-Allow-Headers': 'Content-Type',
                 'Access-Control-Max-Age': '86400'
             },
@@ -31,6 +617,11 @@ def handler(event: dict, context) -> dict:
         body_str = event.get('body', '{}')
         request_data = json.loads(body_str)
         
+        action = request_data.get('action', 'post')
+        
+        if action in ('calendar', 'resume', 'regenerate', 'get'):
+            return handle_calendar(action, request_data, os.environ.get('GEMINI_API_KEY'), get_client_id(event))
+        
         platform = request_data.get('platform', 'социальная сеть')
         task = request_data.get('task', '')
         tone = request_data.get('tone', 'дружелюбный')
@@ -45,55 +636,9 @@ def handler(event: dict, context) -> dict:
                 'body': json.dumps({'error': 'Задача поста не указана'})
             }
         
-        platform_names = {
-            'telegram': 'Telegram',
-            'vk': 'ВКонтакте',
-            'instagram': 'Instagram',
-            'facebook': 'Facebook'
-        }
-        
-        length_desc = {
-            'короткий': 'до 200 символов',
-            'средний': '200-500 символов',
-            'длинный': 'более 500 символов'
-        }
-        
-        emoji_desc = {
-            'нет': 'не использовать эмодзи',
-            'мало': 'использовать 1-2 эмодзи',
-            'баланс': 'использовать 3-5 эмодзи',
-            'много': 'использовать много эмодзи (8-12)'
-        }
-        
-        if tone == 'anya_vibe':
-            tone_instruction = '''Пиши в стиле Ани - учителя английского языка и ИИ. 
-Аня ВЕСЕЛАЯ, ПРОСТАЯ, попадает во всякие нелепые ситуации в жизни и учит английскому языку. 
-Она знает английский в СОВЕРШЕНСТВЕ и часто размышляет о нем, делится интересными фактами о языке, грамматике, произношении.
-ЛЮБИТ ШУТИТЬ и веселиться, пишет легко и непринужденно, как будто болтает с другом.
-Делится забавными историями из практики преподавания и изучения языка.
-
-ВАЖНО:
-- Когда используешь английские слова/фразы, ВСЕГДА пиши перевод в скобках сразу после. Пример: "I'm over the moon (на седьмом небе от счастья)"
-- НЕ пиши о принцах, отношениях, парнях, свиданиях, личной жизни
-- Фокусируйся на английском языке, обучении, забавных ситуациях с изучением языка
-- Тон: живой, энергичный, дружелюбный, с юмором и самоиронией'''
-        else:
-            tone_instruction = f'Тон: {tone}'
-        
-        prompt = f"""Создай пост для {platform_names.get(platform, 'социальной сети')}.
-
-Задача: {task}
-
-Требования:
-- {tone_instruction}
-- Цель поста: {goal}
-- Длина: {length_desc.get(length, '200-500 символов')}
-- Эмодзи: {emoji_desc.get(emojis, 'использовать 3-5 эмодзи')}
-
-Напиши готовый пост для {platform_names.get(platform, '')} канала/группы AnyaGPT. Только текст поста, без пояснений."""
+        prompt = build_post_prompt(platform, task, tone, goal, length, emojis)
         
         gemini_api_key = os.environ.get('GEMINI_API_KEY')
-        proxy_url = os.environ.get('PROXY_URL')
         
         if not gemini_api_key:
             return {
@@ -102,42 +647,20 @@ def handler(event: dict, context) -> dict:
                 'body': json.dumps({'error': 'GEMINI_API_KEY не настроен'})
             }
         
-        gemini_url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp:generateContent?key={gemini_api_key}'
-        
-        gemini_request = {
-            'contents': [{
-                'parts': [{'text': prompt}]
-            }]
-        }
-        
-        req = urllib.request.Request(
-            gemini_url,
-            data=json.dumps(gemini_request).encode('utf-8'),
-            headers={'Content-Type': 'application/json'}
-        )
-        
-        if proxy_url:
-            proxy_handler = urllib.request.ProxyHandler({'http': proxy_url, 'https': proxy_url})
-            opener = urllib.request.build_opener(proxy_handler)
-            urllib.request.install_opener(opener)
+        client_id = get_client_id(event)
+        prompt_tokens, output_tokens = estimate_post_tokens(prompt, length)
+        rejection = admit_request(client_id, prompt_tokens, output_tokens)
+        if rejection:
+            return rejection_response(rejection)
+        record_usage(client_id, prompt_tokens, output_tokens)
         
-        with urllib.request.urlopen(req, timeout=30) as response:
-            gemini_response = json.loads(response.read().decode('utf-8'))
+        generated_text = generate_post_text(prompt, gemini_api_key)
         
-        if 'candidates' in gemini_response and gemini_response['candidates']:
-            generated_text = gemini_response['candidates'][0]['content']['parts'][0]['text']
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'post': generated_text})
-            }
-        else:
-            return {
-                'statusCode': 500,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Не удалось получить ответ от Gemini'})
-            }
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'post': generated_text})
+        }
     
     except urllib.error.HTTPError as e:
         error_body = e.read().decode('utf-8') if e.fp else 'Unknown error'
@@ -1,18 +1,85 @@
 import json
 import os
+import time
 import google.generativeai as genai
 
+MODEL_NAME = 'gemini-2.5-flash'
+
+WARM_STATE = {
+    'loaded_at': time.time(),
+    'warmed_at': None,
+    'invocations': 0,
+    'model': None,
+    'checks': {}
+}
+
+
+def get_model() -> genai.GenerativeModel:
+    '''Возвращает общий для всех вызовов контейнера клиент Gemini'''
+    if WARM_STATE['model'] is None:
+        proxy_url = os.environ.get('PROXY_URL')
+        if proxy_url:
+            os.environ['HTTP_PROXY'] = proxy_url
+            os.environ['HTTPS_PROXY'] = proxy_url
+        genai.configure(api_key=os.environ.get('GEMINI_API_KEY'))
+        WARM_STATE['model'] = genai.GenerativeModel(MODEL_NAME)
+    return WARM_STATE['model']
+
+
+def run_check(check) -> dict:
+    started = time.monotonic()
+    try:
+        check()
+        return {'ok': True, 'ms': round((time.monotonic() - started) * 1000)}
+    except Exception as e:
+        return {'ok': False, 'ms': round((time.monotonic() - started) * 1000), 'error': str(e)}
+
+
+def health_report() -> dict:
+    '''Состояние прогрева контейнера для планировщика'''
+    now = time.time()
+    warmed_at = WARM_STATE['warmed_at']
+    return {
+        'ready': warmed_at is not None and bool(os.environ.get('GEMINI_API_KEY')) and all(check['ok'] for check in WARM_STATE['checks'].values()),
+        'warm': warmed_at is not None,
+        'warmAgeSeconds': round(now - warmed_at, 1) if warmed_at else None,
+        'uptimeSeconds': round(now - WARM_STATE['loaded_at'], 1),
+        'invocations': WARM_STATE['invocations'],
+        'checks': WARM_STATE['checks']
+    }
+
+
+def prewarm() -> dict:
+    '''Прогревает контейнер: клиент Gemini и соединение через прокси'''
+    checks = {'client': run_check(get_model)}
+    checks['gemini'] = run_check(lambda: genai.get_model(f'models/{MODEL_NAME}'))
+    WARM_STATE['checks'] = checks
+    WARM_STATE['warmed_at'] = time.time()
+    return health_report()
+
+
 def handler(event: dict, context) -> dict:
     '''Генерирует темы для документов'''
     
     method = event.get('httpMethod', 'POST')
     
+    WARM_STATE['invocations'] += 1
+    action = (event.get('queryStringParameters') or {}).get('action', '')
+    
+    if action in ('prewarm', 'health'):
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps(prewarm() if action == 'prewarm' else health_report()),
+            'isBase64Encoded': False
+        }
+    
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
                 'Access-Control-Allow-Headers': 'Content-Type'
             },
             'body': '',
@@ -32,15 +99,7 @@ def handler(event: dict, context) -> dict:
                 'isBase64Encoded': False
             }
         
-        api_key = os.environ.get('GEMINI_API_KEY')
-        proxy_url = os.environ.get('PROXY_URL')
-        
-        if proxy_url:
-            os.environ['HTTP_PROXY'] = proxy_url
-            os.environ['HTTPS_PROXY'] = proxy_url
-        
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.5-flash')
+        model = get_model()
         
         sections = max(3, pages // 3)
         prompt = f'''Create structure for document about: {subject}